@@ -1,5 +1,12 @@
+from operator import itemgetter
+
+import numpy as np
 from ete3 import Tree, NodeStyle, TreeStyle, faces
 
+# specific regions a leaf can be from, in the order used by 'biogeo_vec'
+REGIONS = ('SA', 'NA', 'SEA', 'OC', 'AF', 'MAD')
+IDX = {region: i for i, region in enumerate(REGIONS)}
+
 # color for each location
 NODE_COLORS = {
     'SA': "#009E73", 'NA': "#0072B2",
@@ -7,143 +14,333 @@ NODE_COLORS = {
     'AF': "#F0E442", 'MAD': "#CC79A7",
     'americas': '#1E88E5', 'asian-pacific':'#D81B60', 'africa': '#FFC107',
 }
+NODE_COLORS_ARR = np.array([NODE_COLORS[region] for region in REGIONS])
 
-def get_biogeography(node):
+# broader regions and which specific regions (columns of REGIONS) fall into each of them
+BROAD_REGIONS = ('asian-pacific', 'americas', 'africa')
+BROAD_MATRIX = np.array([
+    [0, 0, 1, 1, 0, 0],  # asian-pacific: SEA + OC
+    [1, 1, 0, 0, 0, 0],  # americas: SA + NA
+    [0, 0, 0, 0, 1, 1],  # africa: AF + MAD
+], dtype=np.float32)
+BROAD_COLORS = np.array([NODE_COLORS[region] for region in BROAD_REGIONS])
+
+# fewest levels a subtree needs for the numba kernel to be used. The NumPy path takes a few steps per level, so for
+# shallower trees it is faster than importing numba and loading the compiled kernel
+_JIT_MIN_LEVELS = 40000
+
+# numba kernel made from _aggregate by _get_aggregate_jit. None until first needed, False if numba isn't installed
+_aggregate_jit = None
+
+def _aggregate(parent, child_count, probs):
     '''
-    Find biogeographic information of ete3 node and places it in 'biogeo' feature
-    :param node: the ete3 node to get the biogeography information of
+    Fills in probs of internal nodes as the mean of their children. Every parent's row must come before its children's
+    :param parent: row of each node's parent, or -1 for the root of the subtree
+    :param child_count: number of children of each node, 0 for leaves
+    :param probs: array with one row per node holding the probability of each region in REGIONS order, leaves filled in
+    '''
+    num_regions = probs.shape[1]
+    for i in range(probs.shape[0] - 1, -1, -1):
+        # every child has added itself by now, so divide to get the mean
+        if child_count[i]:
+            for r in range(num_regions):
+                probs[i, r] /= child_count[i]
+        if parent[i] >= 0:
+            for r in range(num_regions):
+                probs[parent[i], r] += probs[i, r]
+
+def _get_aggregate_jit():
+    '''
+    Compiles _aggregate with numba the first time it is needed, so trees too shallow for it don't pay for the import
+    :return: the compiled kernel, or False if numba is not installed, in which case the NumPy code path is used
+    '''
+    global _aggregate_jit
+    if _aggregate_jit is None:
+        try:
+            from numba import njit
+        except ImportError:
+            _aggregate_jit = False
+        else:
+            _aggregate_jit = njit(nogil=True, cache=True)(_aggregate)
+    return _aggregate_jit
+
+def biogeo_dict(vec):
+    '''
+    Converts a biogeography vector into a readable dictionary
+    :param vec: array holding the probability of each region in REGIONS order
     :return: a dictionary with format {location: chance of originating at location}
     '''
+    return {region: p for region, p in zip(REGIONS, vec.tolist()) if p}
 
-    # if a leaf, find location and return 100% chance to be at said location
-    if node.is_leaf():
-        name = node.name
-        # leaves are named <Genus>_<species>_<accession>_<location>
-        index = len(name) - 1
-        while name[index] != '_':
-            index -= 1
+def sorted_biogeo(node):
+    '''
+    Gets biogeographic information of a node ordered for display
+    :param node: the ete3 node with a 'biogeo_vec' feature
+    :return: a list of (location, chance of originating at location) tuples, sorted by highest probability
+    '''
+    return sorted(biogeo_dict(node.biogeo_vec).items(), key=itemgetter(1), reverse=True)
 
-        # add 100% chance to originate at location
-        node.add_feature('biogeo', {name[index + 1:]: 1})
+def _parse_leaf(node):
+    '''
+    Finds location of a leaf and renames it to 'Genus species'. The original name and the index of the location are
+    kept on the leaf, so the accession isn't lost and later calls don't parse the already changed name
+    :param node: leaf named <Genus>_<species>_<accession>_<location>
+    :return: index of the leaf's location in REGIONS
+    :raises ValueError: if the location is not one of REGIONS
+    '''
+    region = getattr(node, '_region', None)
+    if region is not None:
+        return region
+    parts = node.name.split('_')
+    if parts[-1] not in IDX:
+        raise ValueError(f"leaf '{node.name}' has unknown location '{parts[-1]}', "
+                         f"expected one of {', '.join(REGIONS)}")
+    node._orig_name = node.name
+    node._region = IDX[parts[-1]]
+    node.name = parts[0] + ' ' + parts[1]
+    return node._region
 
-        # change name to be 'Genus species'
-        space = node.name.find('_')
-        cutoff = node.name[space + 1:].find('_')
-        node.name = node.name[:space] + ' ' + node.name[space + 1:][:cutoff]
+def _flatten(node):
+    '''
+    Lists the nodes of a subtree level by level, so every parent comes before its children and the children of a
+    parent are next to each other, right after the children of the nodes before it
+    :param node: root of the subtree
+    :return: list of nodes and array with the number of children of each node
+    '''
+    nodes = [node]
+    child_count = []
+    # the loop also visits the children added to the end of nodes while it runs
+    for current in nodes:
+        children = current.children
+        nodes += children
+        child_count.append(len(children))
+    return nodes, np.array(child_count, dtype=np.intp)
+
+def _level_bounds(child_count):
+    '''
+    Finds where each level of a subtree listed by _flatten starts
+    :param child_count: array with the number of children of each node, in the order given by _flatten
+    :return: list of where each level starts, ending with the number of nodes
+    '''
+    # each level is directly followed by the children of its nodes
+    total = np.cumsum(child_count)
+    bounds = [0, 1]
+    while bounds[-1] < len(child_count):
+        bounds.append(1 + int(total[bounds[-1] - 1]))
+    return bounds
 
-        return {name[index + 1:]: 1}
-    # if not leaf then base biogeography on child nodes
+def _parents(child_count):
+    '''
+    Finds the parent of each node of a subtree listed by _flatten
+    :param child_count: array with the number of children of each node, in the order given by _flatten
+    :return: array with the row of each node's parent, or -1 for the root of the subtree
+    '''
+    return np.concatenate(([-1], np.repeat(np.arange(len(child_count)), child_count)))
+
+def _aggregate_levels(child_count, bounds, probs):
+    '''
+    Fills in probs of internal nodes as the mean of their children, one level at a time from the deepest
+    :param child_count: array with the number of children of each node, in the order given by _flatten
+    :param bounds: list of where each level starts, as given by _level_bounds
+    :param probs: array with one row per node holding the probability of each region in REGIONS order, leaves filled in
+    '''
+    for k in range(len(bounds) - 3, -1, -1):
+        start, end, children_end = bounds[k], bounds[k + 1], bounds[k + 2]
+        counts = child_count[start:end]
+
+        # children of the same parent are next to each other, so each parent's run of rows is summed at once
+        internal = np.flatnonzero(counts)
+        first = np.cumsum(counts)[internal] - counts[internal]
+        probs[start + internal] = np.add.reduceat(probs[end:children_end], first) / counts[internal, None]
+
+def _compute_biogeography(node):
+    '''
+    Finds biogeographic information of every node in a subtree and places it in their 'biogeo_vec' features
+    :param node: root of the subtree
+    :return: list of nodes and array with one row per node holding the probability of each region in REGIONS order
+    '''
+    nodes, child_count = _flatten(node)
+
+    # rows are attached as views and filled in below. Attaching before leaves are parsed keeps every node's
+    # attributes in the same order, which lets python share their key table instead of giving each node its own dict
+    probs = np.zeros((len(nodes), len(REGIONS)), dtype=np.float32)
+    for current, vec in zip(nodes, probs):
+        current.add_feature('biogeo_vec', vec)
+
+    # give each leaf 100% chance to be at its location
+    leaves = np.flatnonzero(child_count == 0)
+    probs[leaves, [_parse_leaf(nodes[i]) for i in leaves.tolist()]] = 1.0
+
+    # base biogeography of internal nodes on their children. Each child is weighted the same.
+    bounds = _level_bounds(child_count)
+    if len(bounds) - 1 >= _JIT_MIN_LEVELS and _get_aggregate_jit():
+        _aggregate_jit(_parents(child_count), child_count, probs)
     else:
-        biogeo = {}
-        num_child = len(node.children)
+        _aggregate_levels(child_count, bounds, probs)
 
-        # go through each child and add biogeography info into dictionary. Each child is weighted the same.
-        for child in node.children:
-            child_biogeo = get_biogeography(child)
-            for location in child_biogeo:
-                if location in biogeo:
-                    biogeo[location] += child_biogeo[location] / num_child
-                else:
-                    biogeo[location] = child_biogeo[location] / num_child
+    return nodes, probs
 
-        # sort dictionary by highest probability and add biogeo feature to node
-        node.add_feature('biogeo', dict(sorted(biogeo.items(), key=lambda x:x[1], reverse=True)))
-        return biogeo
+def get_biogeography(node):
+    '''
+    Find biogeographic information of ete3 node and places it in 'biogeo_vec' features of it and its descendants.
+    A readable dictionary of a node's 'biogeo_vec' can be made with biogeo_dict
+    :param node: the ete3 node to get the biogeography information of
+    :return: a dictionary with format {location: chance of originating at location}
+    :raises ValueError: if a leaf's location is not one of REGIONS
+    '''
+    _compute_biogeography(node)
+    return biogeo_dict(node.biogeo_vec)
 
-def get_color(biogeo):
+def get_color(vec):
     '''
     Gets color of node based on biogeo information
-    :param biogeo: dictionary holding locations as keys and probabilities as values
+    :param vec: array holding the probability of each region in REGIONS order
     :return: Color corresponding to most probable location
     '''
-    max = 0;
-    loc = ''
-    for location in biogeo:
-        if biogeo[location] > max:
-            loc = location
-            max = biogeo[location]
-    return NODE_COLORS[loc]
+    return NODE_COLORS_ARR[vec.argmax()].item()
 
-def get_color_broad(biogeo):
+def get_color_broad(vec):
     '''
     Gets color of node based on a broader category of biogeo information
-    :param biogeo: dictionary holding locations as keys and probabilities as values
+    :param vec: array holding the probability of each region in REGIONS order
     :return: Color corresponding to most probable location
     '''
+    # combine specific regions into broader regions and return color of most probable one (first one on ties)
+    return BROAD_COLORS[np.argmax(BROAD_MATRIX @ vec)].item()
 
-    # get probabilities of each specific region
-    sea = biogeo['SEA'] if 'SEA' in biogeo else 0
-    oc = biogeo['OC'] if 'OC' in biogeo else 0
-    sa = biogeo['SA'] if 'SA' in biogeo else 0
-    na = biogeo['NA'] if 'NA' in biogeo else 0
-    af = biogeo['AF'] if 'AF' in biogeo else 0
-    mad = biogeo['MAD'] if 'MAD' in biogeo else 0
-
-    # get combined scores of broader regions
-    asian_pacific = sea + oc
-    americas = sa + na
-    africa = af + mad
+def get_colors(probs, specific):
+    '''
+    Gets colors of many nodes at once based on their biogeo information
+    :param probs: array with one row per node holding the probability of each region in REGIONS order
+    :param specific: True if by specific location or False if broader classification
+    :return: list of colors corresponding to the most probable location of each node
+    '''
+    if specific:
+        return NODE_COLORS_ARR[probs.argmax(axis=1)].tolist()
+    return BROAD_COLORS[get_broad_probs(probs).argmax(axis=1)].tolist()
 
-    # get highest probability and return color
-    score_dict = {asian_pacific: 'asian-pacific', americas: 'americas', africa: 'africa'}
-    winner = score_dict[max(asian_pacific, americas, africa)]
-    return NODE_COLORS[winner]
+def get_broad_probs(probs):
+    '''
+    Combines specific region probabilities of many nodes into broader region probabilities at once
+    :param probs: array with one row per node holding the probability of each region in REGIONS order
+    :return: array with one row per node holding the probability of each region in BROAD_REGIONS order
+    '''
+    return probs @ BROAD_MATRIX.T
 
-def add_pie_chart_node(node, specific):
+def _pie_face(node, specific, broad=None):
     '''
-    Adds pie chart face to internal node
-    :param node: node to add pie chart to
+    Makes the pie chart face of an internal node without adding it
+    :param node: node to make pie chart for
     :param specific: True if by specific location or False if broader classification
+    :param broad: optional already combined probabilities of BROAD_REGIONS for the node, used if not specific
+    :return: the pie chart face
     '''
-    biogeo = node.biogeo
-    locations = []
-    colors = []
     diameter = 30
 
     if specific:
-        # Go through each location and add it to piechart list and its probability
-        for location in biogeo:
-            locations.append(100 * biogeo[location])
-            colors.append(NODE_COLORS[location])
-    else:
-        # get probabilities of each specific region
-        sea = biogeo['SEA'] if 'SEA' in biogeo else 0
-        oc = biogeo['OC'] if 'OC' in biogeo else 0
-        sa = biogeo['SA'] if 'SA' in biogeo else 0
-        na = biogeo['NA'] if 'NA' in biogeo else 0
-        af = biogeo['AF'] if 'AF' in biogeo else 0
-        mad = biogeo['MAD'] if 'MAD' in biogeo else 0
+        # regions are read by their index in REGIONS so no string keys are hashed
+        probs = node.biogeo_vec.tolist()
 
+        # Go through each location, most probable first, and add it to piechart list and its probability
+        order = sorted((i for i in range(len(REGIONS)) if probs[i]), key=probs.__getitem__, reverse=True)
+        locations = [100 * probs[i] for i in order]
+        colors = NODE_COLORS_ARR[order].tolist()
+    else:
         # get combined scores of broader regions
-        asian_pacific = sea + oc
-        americas = sa + na
-        africa = af + mad
+        if broad is None:
+            broad = BROAD_MATRIX @ node.biogeo_vec
 
         # add locations and probabilities
-        locations.append(100 * asian_pacific)
-        colors.append(NODE_COLORS['asian-pacific'])
-        locations.append(100 * americas)
-        colors.append(NODE_COLORS['americas'])
-        locations.append(100 * africa)
-        colors.append(NODE_COLORS['africa'])
+        locations = (100 * broad).tolist()
+        colors = BROAD_COLORS.tolist()
+
+    return faces.PieChartFace(locations, diameter, diameter, colors=colors)
+
+def _set_pie_face(node, face):
+    '''
+    Puts a pie chart face on an internal node in place of the one it had
+    :param node: node to add pie chart to
+    :param face: pie chart face made by _pie_face
+    '''
+    # replace any pie chart added before so switching between specific and broad doesn't stack them
+    if hasattr(node, '_pie_face'):
+        getattr(node.faces, 'branch-right')[0].remove(node._pie_face)
 
     # put piechart as face and get rid of normal node circle
+    node._pie_face = face
     node.img_style["size"] = 0
-    node.add_face(faces.PieChartFace(locations, diameter, diameter, colors=colors), 0)
+    node.add_face(face, 0)
 
-def add_pie_chart_leaf(node, specific):
+def add_pie_chart_node(node, specific, broad=None):
+    '''
+    Adds pie chart face to internal node
+    :param node: node to add pie chart to
+    :param specific: True if by specific location or False if broader classification
+    :param broad: optional already combined probabilities of BROAD_REGIONS for the node, used if not specific
+    '''
+    _set_pie_face(node, _pie_face(node, specific, broad))
+
+def _leaf_style(color, style_cache):
+    '''
+    Gets the style of leaves of a color, making it if style_cache doesn't have it yet
+    :param color: color of the leaf's location
+    :param style_cache: dictionary of already made styles, keyed by color
+    :return: the NodeStyle for the color
+    '''
+    nstyle = style_cache.get(color)
+    if nstyle is None:
+        nstyle = style_cache[color] = NodeStyle(fgcolor=color, size=20)
+    return nstyle
+
+def add_pie_chart_leaf(node, color, style_cache=None):
     '''
     Adds a 'pie chart' to a leaf, but since it is only form one lcoation it just changes color of node
     :param node: leaf to color
+    :param color: color of the leaf's location
+    :param style_cache: optional dictionary of already made styles, keyed by color, to reuse between leaves. Leaves
+    styled with the same cache share one mutable NodeStyle per color, so changing img_style of one of them changes it
+    for every leaf of that color
+    '''
+    if style_cache is None:
+        style_cache = {}
+
+    # leaves of the same color share one style instead of each making their own
+    node.set_style(_leaf_style(color, style_cache))
+
+def _make_styles(nodes, probs, specific):
+    '''
+    Makes the style of every node without applying it. Styles are made one at a time as they are asked for, so
+    applying them straight away frees each replaced pie chart before the next one is made
+    :param nodes: list of nodes to make styles for
+    :param probs: array with one row per node holding the probability of each region in REGIONS order
     :param specific: True if by specific location or False if broader classification
+    :return: generator of the NodeStyle of each leaf and the pie chart face of each internal node, in the order of nodes
     '''
-    nstyle = NodeStyle()
-    if specific:
-        nstyle['fgcolor'] = get_color(node.biogeo)
-    else:
-        nstyle['fgcolor'] = get_color_broad(node.biogeo)
-    nstyle['size'] = 20
-    node.set_style(nstyle)
+    # colors of all leaves in one batch, handed out in the same order below
+    is_leaf = [node.is_leaf() for node in nodes]
+    colors = iter(get_colors(probs[np.flatnonzero(is_leaf)], specific))
+
+    # broader region probabilities of every node in one matrix product
+    broad = None if specific else get_broad_probs(probs)
+
+    style_cache = {}
+    for i, node in enumerate(nodes):
+        if is_leaf[i]:
+            yield _leaf_style(next(colors), style_cache)
+        else:
+            yield _pie_face(node, specific, None if broad is None else broad[i])
+
+def _apply_styles(nodes, styles):
+    '''
+    Colors leaves and puts pie charts on internal nodes
+    :param nodes: list of nodes to style
+    :param styles: styles made for nodes by _make_styles, in the order of nodes
+    '''
+    for node, style in zip(nodes, styles):
+        if isinstance(style, NodeStyle):
+            node.set_style(style)
+        else:
+            _set_pie_face(node, style)
 
 def add_pie_chart_all(tree, specific):
     '''
@@ -151,11 +348,43 @@ def add_pie_chart_all(tree, specific):
     :param tree: Tree to color and add pie charts to
     :param specific: True if by specific location or False if broader classification
     '''
-    for node in tree.traverse():
-        if node.is_leaf():
-            add_pie_chart_leaf(node, specific)
-        else:
-            add_pie_chart_node(node, specific)
+    nodes = list(tree.traverse())
+    probs = np.stack([node.biogeo_vec for node in nodes])
+    _apply_styles(nodes, _make_styles(nodes, probs, specific))
+
+def analyze_and_style(tree, specific):
+    '''
+    Finds biogeography of and adds pie charts to whole of tree, reusing the matrix of probabilities for styling.
+    Styles of both classifications are made so restyle can switch between them. Use instead of get_biogeography
+    followed by add_pie_chart_all
+    :param tree: Tree to find biogeography of, color and add pie charts to
+    :param specific: True if by specific location or False if broader classification
+    :return: a dictionary with format {location: chance of originating at location} for the root of tree
+    :raises ValueError: if a leaf's location is not one of REGIONS
+    '''
+    nodes, probs = _compute_biogeography(tree)
+
+    # kept on the root with the matrix they were made from, so restyle can tell if biogeography was found again since
+    views = {view: list(_make_styles(nodes, probs, view)) for view in (True, False)}
+    tree._biogeo_views = (probs, nodes, views)
+    _apply_styles(nodes, views[specific])
+    return biogeo_dict(tree.biogeo_vec)
+
+def restyle(tree, specific):
+    '''
+    Switches a tree styled by analyze_and_style between specific and broader classification by swapping in the styles
+    it made, with no arithmetic. Trees not styled that way, or whose biogeography was found again since, are styled by
+    add_pie_chart_all instead
+    :param tree: Tree with biogeography information, already styled or not
+    :param specific: True if by specific location or False if broader classification
+    '''
+    saved = getattr(tree, '_biogeo_views', None)
+    if saved is None or tree.biogeo_vec.base is not saved[0]:
+        add_pie_chart_all(tree, specific)
+        return
+
+    _, nodes, views = saved
+    _apply_styles(nodes, views[specific])
 
 if __name__ == '__main__':
     # load tree from file containing newick
@@ -165,8 +394,7 @@ if __name__ == '__main__':
     # Calculate biogeography chance and color nodes
     tree.ladderize(direction=0)
     parrot_node = tree.children[1]
-    get_biogeography(parrot_node)
-    add_pie_chart_all(parrot_node, False)
+    analyze_and_style(parrot_node, False)
 
     # extra tree styling
     ts = TreeStyle()
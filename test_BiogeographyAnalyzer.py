@@ -0,0 +1,81 @@
+import numpy as np
+import pytest
+from ete3 import Tree
+
+import BiogeographyAnalyzer as ba
+
+
+def _random_tree(num_leaves, seed):
+    rng = np.random.default_rng(seed)
+    tree = Tree()
+    tree.populate(num_leaves)
+    for i, leaf in enumerate(tree.iter_leaves()):
+        leaf.name = f'Genus_species{i}_{rng.choice(ba.REGIONS)}'
+    return tree
+
+def _deep_tree(depth):
+    tree = Tree()
+    node = tree
+    for i in range(depth):
+        node.add_child(name=f'Genus_species{i}_{ba.REGIONS[i % len(ba.REGIONS)]}')
+        node = node.add_child()
+    node.name = 'Genus_species_AF'
+    return tree
+
+def test_biogeography_values():
+    # a single child, a leaf next to internal nodes and a node with three children
+    tree = Tree('((A_b_c_SA),B_b_c_NA,(C_d_e_SA,D_e_f_AF));')
+    assert ba.get_biogeography(tree) == pytest.approx({'SA': 1 / 2, 'NA': 1 / 3, 'AF': 1 / 6})
+    assert ba.biogeo_dict(tree.children[0].biogeo_vec) == pytest.approx({'SA': 1})
+    assert ba.biogeo_dict(tree.children[2].biogeo_vec) == pytest.approx({'SA': 1 / 2, 'AF': 1 / 2})
+
+def test_repeated_calls():
+    tree = Tree('((A_b_c1_SA,A_b_c2_NA),C_d_e_AF);')
+    first = ba.get_biogeography(tree)
+    assert ba.get_biogeography(tree) == first
+    assert [leaf.name for leaf in tree] == ['A b', 'A b', 'C d']
+    assert [leaf._orig_name for leaf in tree] == ['A_b_c1_SA', 'A_b_c2_NA', 'C_d_e_AF']
+
+def _check_styles(tree, specific):
+    palette = set((ba.NODE_COLORS_ARR if specific else ba.BROAD_COLORS).tolist())
+    for node in tree.traverse():
+        if node.is_leaf():
+            color = ba.get_color(node.biogeo_vec) if specific else ba.get_color_broad(node.biogeo_vec)
+            assert node.img_style['fgcolor'] == color
+        else:
+            # switching views replaces the pie chart instead of adding another
+            assert getattr(node.faces, 'branch-right')[0] == [node._pie_face]
+            assert set(node._pie_face.colors) <= palette
+
+def test_restyle():
+    tree = Tree('((A_b_c_SA,B_c_d_SEA),(C_d_e_AF,D_e_f_NA),E_f_g_OC);')
+    ba.analyze_and_style(tree, False)
+    _check_styles(tree, False)
+    ba.restyle(tree, True)
+    _check_styles(tree, True)
+    ba.restyle(tree, False)
+    _check_styles(tree, False)
+
+    # styled without the views analyze_and_style makes
+    ba.get_biogeography(tree)
+    ba.add_pie_chart_all(tree, True)
+    ba.restyle(tree, False)
+    _check_styles(tree, False)
+
+@pytest.mark.parametrize('tree', [_random_tree(5000, 0), _deep_tree(2000)], ids=['random', 'deep'])
+def test_jit_matches_numpy(tree):
+    pytest.importorskip('numba')
+    _, child_count = ba._flatten(tree)
+    probs = ba._compute_biogeography(tree)[1]
+    leaves = child_count == 0
+    numpy_probs = np.where(leaves[:, None], probs, 0)
+    jit_probs = numpy_probs.copy()
+    ba._aggregate_levels(child_count, ba._level_bounds(child_count), numpy_probs)
+    ba._get_aggregate_jit()(ba._parents(child_count), child_count, jit_probs)
+    np.testing.assert_allclose(jit_probs, numpy_probs, rtol=1e-6)
+    assert np.allclose(numpy_probs.sum(axis=1), 1)
+
+def test_unknown_location():
+    tree = Tree('(Falco_peregrinus_U83307.1,Ara_macao_SA);')
+    with pytest.raises(ValueError, match='Falco_peregrinus_U83307.1'):
+        ba.get_biogeography(tree)